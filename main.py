@@ -2,7 +2,7 @@
 import os
 import yaml
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime, timedelta
 import base64
 import requests
@@ -19,67 +19,934 @@ import re
 import asyncio
 import signal
 import sys
+import json
+import contextvars
+import functools
+import queue
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Отключаем предупреждения о небезопасном SSL
 warnings.filterwarnings('ignore', category=InsecureRequestWarning)
 
+# Текущая трассировка обрабатываемого апдейта (None, если трассировка выключена)
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class TraceIdFilter(logging.Filter):
+    """Add trace_id of the current update to every log record."""
+
+    def filter(self, record):
+        trace = _current_trace.get()
+        record.trace_id = trace.trace_id if trace is not None else "-"
+        return True
+
+
 # Configure logging
-log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
+trace_id_filter = TraceIdFilter()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 # Console handler
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
+console_handler.addFilter(trace_id_filter)
 logger.addHandler(console_handler)
 
 # File handler
 try:
     file_handler = RotatingFileHandler("bot.log", maxBytes=1024*1024, backupCount=5)
     file_handler.setFormatter(log_formatter)
+    file_handler.addFilter(trace_id_filter)
     logger.addHandler(file_handler)
     logger.info("Логирование инициализировано успешно")
 except Exception as e:
     logger.error(f"Ошибка инициализации файлового логирования: {str(e)}")
 
-class GigaChatBot:
-    def __init__(self, bot_token, allowed_chat_ids, client_id, client_secret):
-        """Initialize the GigaChat bot with the given credentials."""
-        self.bot_token = bot_token
-        self.allowed_chat_ids = [int(chat_id) for chat_id in allowed_chat_ids]
+class _NoopSpan:
+    """Span-заглушка: используется, когда трассировка выключена."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """Timed operation inside a trace (Telegram call, GigaChat request, etc.)."""
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes",
+                 "start", "duration_ms", "status", "_token")
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.span_id = trace.next_span_id()
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else 0
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration_ms = None
+        self.status = "ok"
+        self._token = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        if exc_type is not None:
+            self.status = "error"
+            self.attributes["error"] = repr(exc)
+        _current_span.reset(self._token)
+        self.trace.spans.append(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 2),
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """Root of the span tree for a single Telegram update."""
+    __slots__ = ("tracer", "trace_id", "name", "attributes", "started_at", "start",
+                 "duration_ms", "status", "spans", "_span_counter", "_tokens")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.started_at = None
+        self.start = None
+        self.duration_ms = None
+        self.status = "ok"
+        self.spans = []
+        self._span_counter = 0
+        self._tokens = None
+
+    def next_span_id(self):
+        self._span_counter += 1
+        return self._span_counter
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self._tokens = (_current_trace.set(self), _current_span.set(None))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        if exc_type is not None:
+            self.status = "error"
+            self.attributes["error"] = repr(exc)
+        try:
+            # Завершаем до сброса контекста, чтобы trace_id попал в логи экспорта
+            self.tracer.finish(self)
+        finally:
+            trace_token, span_token = self._tokens
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+        return False
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "attributes": self.attributes,
+            "spans": [span.to_dict() for span in sorted(self.spans, key=lambda s: s.start)],
+        }
+
+
+class RequestTracer:
+    """Span-based tracing of updates with JSONL export and a slow-request log.
+
+    When tracing is disabled trace() and span() return a shared no-op object,
+    so instrumented code pays only for a context variable lookup. Both files
+    are rotated like bot.log and written from a background thread, so the
+    event loop only serializes the trace and puts it into a queue.
+    """
+
+    def __init__(self, enabled=False, export_path="traces.jsonl",
+                 slow_log_path="slow_requests.jsonl", slow_threshold_ms=5000,
+                 max_bytes=10*1024*1024, backup_count=5):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.slow_log_path = slow_log_path
+        self.slow_threshold_ms = slow_threshold_ms
+        self._export_logger = None
+        self._slow_logger = None
+        self._listeners = []
+        if enabled:
+            self._export_logger = self._create_jsonl_logger("traces", export_path, max_bytes, backup_count)
+            self._slow_logger = self._create_jsonl_logger("slow_requests", slow_log_path, max_bytes, backup_count)
+            atexit.register(self.shutdown)
+            logger.info("Трассировка включена: экспорт в %s, порог медленных запросов %s мс",
+                        export_path, slow_threshold_ms)
+
+    def _create_jsonl_logger(self, name, path, max_bytes, backup_count):
+        """Create a logger writing one JSON record per line to a rotated file."""
+        if not path:
+            return None
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, handler)
+        listener.start()
+        self._listeners.append(listener)
+
+        jsonl_logger = logging.getLogger(f"{__name__}.{name}")
+        jsonl_logger.setLevel(logging.INFO)
+        jsonl_logger.propagate = False
+        jsonl_logger.addHandler(QueueHandler(records))
+        return jsonl_logger
+
+    def shutdown(self):
+        """Flush queued trace records to disk."""
+        for listener in self._listeners:
+            listener.stop()
+        self._listeners = []
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a tracer from the optional 'tracing' section of secrets.yaml."""
+        config = config or {}
+        return cls(
+            enabled=bool(config.get("enabled", False)),
+            export_path=config.get("export_path", "traces.jsonl"),
+            slow_log_path=config.get("slow_log_path", "slow_requests.jsonl"),
+            slow_threshold_ms=float(config.get("slow_threshold_ms", 5000)),
+            max_bytes=int(config.get("max_bytes", 10*1024*1024)),
+            backup_count=int(config.get("backup_count", 5)),
+        )
+
+    def trace(self, name, **attributes):
+        """Start a trace for an update, or a nested span if one is already active."""
+        if not self.enabled:
+            return _NOOP_SPAN
+        if _current_trace.get() is not None:
+            return self.span(name, **attributes)
+        return Trace(self, name, attributes)
+
+    def span(self, name, **attributes):
+        """Start a span inside the current trace."""
+        trace = _current_trace.get()
+        if trace is None:
+            return _NOOP_SPAN
+        return Span(trace, name, attributes)
+
+    def finish(self, trace):
+        """Export a finished trace and record it in the slow log if needed."""
+        record = json.dumps(trace.to_dict(), ensure_ascii=False)
+        is_slow = trace.duration_ms >= self.slow_threshold_ms
+        if self._export_logger is not None:
+            self._export_logger.info(record)
+        if is_slow and self._slow_logger is not None:
+            self._slow_logger.info(record)
+
+        if is_slow:
+            breakdown = ", ".join(
+                f"{span.name}={span.duration_ms:.0f}ms"
+                for span in sorted(trace.spans, key=lambda s: s.start)
+            )
+            logger.warning("Медленный запрос %s: %.0f мс (%s)", trace.name, trace.duration_ms, breakdown)
+
+
+def request_id_header():
+    """Return X-Request-ID header carrying the current trace id, if any."""
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+    return {"X-Request-ID": trace.trace_id}
+
+
+def set_trace_attribute(key, value):
+    """Set an attribute on the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.set(key, value)
+
+
+def traced(name):
+    """Wrap a Telegram handler into a trace named after the handler."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, update, context):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            with self.tracer.trace(name, chat_id=chat_id):
+                return await handler(self, update, context)
+        return wrapper
+    return decorator
+
+
+class LaneRejectedError(Exception):
+    """Raised when a lane's queue is full and the request is not admitted."""
+
+
+class _LaneState:
+    """Concurrency budget, queue and latency metrics of a single lane."""
+
+    def __init__(self, name, concurrency, max_queue, window):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"lane-{name}")
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.queue_waits = deque(maxlen=window)
+        # (time.monotonic(), latency_ms) последних запросов
+        self.latencies = deque(maxlen=window)
+
+    def recent_latencies(self, max_age_s):
+        """Return latencies of requests finished within the last max_age_s."""
+        since = time.monotonic() - max_age_s
+        return [latency for finished, latency in self.latencies if finished >= since]
+
+
+def _percentile(values, percent):
+    """Return the given percentile of a sequence of numbers (0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class PriorityLaneExecutor:
+    """Runs blocking GigaChat calls in separate priority lanes.
+
+    Every lane has its own thread pool and concurrency budget, so heavy
+    /image and file analysis work cannot occupy the workers used for
+    interactive text. While the text latency SLO is breached the heavy
+    lanes are throttled to a single request in flight: new heavy requests
+    wait for admission and are rejected if the SLO is still breached after
+    max_admission_wait_s or once the lane queue is full.
+
+    The SLO is checked against p95 of text requests finished within the last
+    slo_window_s seconds. The measured latency is the whole GigaChat call of a
+    text reply: lane queue wait plus the full non-streaming completion,
+    including generation of up to max_tokens tokens. The default SLO is set
+    accordingly and must not be compared with time to first token.
+    """
+
+    INTERACTIVE_LANE = "text"
+    DEFAULT_LANES = {
+        "text": {"concurrency": 8, "max_queue": 100},
+        "image": {"concurrency": 2, "max_queue": 10},
+        "file": {"concurrency": 2, "max_queue": 10},
+    }
+
+    def __init__(self, lanes=None, text_latency_slo_ms=30000, slo_window_s=60,
+                 max_admission_wait_s=30, window=100, min_samples=5):
+        lanes = lanes or self.DEFAULT_LANES
+        self.text_latency_slo_ms = text_latency_slo_ms
+        self.slo_window_s = slo_window_s
+        self.max_admission_wait_s = max_admission_wait_s
+        self.min_samples = min_samples
+        self._lanes = {
+            name: _LaneState(name, int(cfg["concurrency"]), int(cfg["max_queue"]), window)
+            for name, cfg in lanes.items()
+        }
+        if self.INTERACTIVE_LANE not in self._lanes:
+            raise ValueError(f"Lane '{self.INTERACTIVE_LANE}' must be configured")
+
+    @classmethod
+    def from_config(cls, config, scale=1):
+        """Create an executor from the optional 'lanes' section of secrets.yaml.
+
+        Default concurrency budgets are multiplied by scale (the number of
+        GigaChat keys), explicitly configured budgets are used as is.
+        """
+        config = config or {}
+        lanes = {}
+        for name, defaults in cls.DEFAULT_LANES.items():
+            lane_config = config.get(name) or {}
+            lanes[name] = {
+                "concurrency": lane_config.get("concurrency", defaults["concurrency"] * scale),
+                "max_queue": lane_config.get("max_queue", defaults["max_queue"]),
+            }
+        return cls(
+            lanes=lanes,
+            text_latency_slo_ms=float(config.get("text_latency_slo_ms", 30000)),
+            slo_window_s=float(config.get("slo_window_s", 60)),
+            max_admission_wait_s=float(config.get("max_admission_wait_s", 30)),
+        )
+
+    @property
+    def total_concurrency(self):
+        return sum(state.concurrency for state in self._lanes.values())
+
+    def text_slo_breached(self):
+        """Check whether p95 latency of recent text requests exceeds the SLO."""
+        latencies = self._lanes[self.INTERACTIVE_LANE].recent_latencies(self.slo_window_s)
+        if len(latencies) < self.min_samples:
+            return False
+        return _percentile(latencies, 95) > self.text_latency_slo_ms
+
+    async def _admit(self, state):
+        """Wait until the lane may start one more request."""
+        if state.queued >= state.max_queue:
+            state.rejected += 1
+            raise LaneRejectedError(f"Lane '{state.name}' queue is full ({state.queued})")
+
+        state.queued += 1
+        try:
+            if state.name != self.INTERACTIVE_LANE:
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + self.max_admission_wait_s
+                throttled = False
+                while state.running > 0 and self.text_slo_breached():
+                    if loop.time() >= deadline:
+                        # Не пропускаем накопившиеся запросы с полным бюджетом,
+                        # пока текстовые ответы все еще медленные
+                        state.rejected += 1
+                        raise LaneRejectedError(
+                            f"Lane '{state.name}' throttled for {self.max_admission_wait_s:g}s, text SLO still breached"
+                        )
+                    if not throttled:
+                        throttled = True
+                        state.throttled += 1
+                        logger.info("Текстовый SLO нарушен, откладываем запрос в полосе %s", state.name)
+                    await asyncio.sleep(0.25)
+            await state.semaphore.acquire()
+        finally:
+            state.queued -= 1
+
+    async def run(self, lane, func, *args, **kwargs):
+        """Run a blocking callable in the given lane and return its result."""
+        state = self._lanes[lane]
+        loop = asyncio.get_running_loop()
+        enqueued = time.perf_counter()
+        await self._admit(state)
+        started = time.perf_counter()
+        queue_wait_ms = (started - enqueued) * 1000
+        state.running += 1
+        try:
+            result = await loop.run_in_executor(state.executor, functools.partial(func, *args, **kwargs))
+        except Exception:
+            state.failed += 1
+            raise
+        finally:
+            state.running -= 1
+            state.semaphore.release()
+            latency_ms = (time.perf_counter() - enqueued) * 1000
+            state.queue_waits.append(queue_wait_ms)
+            state.latencies.append((time.monotonic(), latency_ms))
+            span = _current_span.get()
+            if span is not None:
+                span.set("lane", lane)
+                span.set("lane_wait_ms", round(queue_wait_ms, 2))
+        state.completed += 1
+        return result
+
+    def snapshot(self):
+        """Return per-lane queue and latency metrics over the last requests."""
+        snapshot = {}
+        for name, state in self._lanes.items():
+            latencies = [latency for _, latency in state.latencies]
+            snapshot[name] = {
+                "concurrency": state.concurrency,
+                "running": state.running,
+                "queued": state.queued,
+                "completed": state.completed,
+                "failed": state.failed,
+                "rejected": state.rejected,
+                "throttled": state.throttled,
+                "queue_wait_p50_ms": round(_percentile(state.queue_waits, 50), 1),
+                "queue_wait_p95_ms": round(_percentile(state.queue_waits, 95), 1),
+                "latency_p50_ms": round(_percentile(latencies, 50), 1),
+                "latency_p95_ms": round(_percentile(latencies, 95), 1),
+            }
+        return snapshot
+
+    def shutdown(self):
+        """Stop lane thread pools; running requests are allowed to finish."""
+        for state in self._lanes.values():
+            state.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class GigaChatCredential:
+    """GigaChat authorization key with its own access token and rate-limit state."""
+
+    def __init__(self, index, client_id, client_secret):
+        self.index = index
         self.client_id = client_id
         self.client_secret = client_secret
         self.access_token = None
         self.token_expiry = None
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.auth_failures = 0
+        self.consecutive_auth_failures = 0
+        self.cooldown_until = 0.0
+        self.cooldown_reason = None
+        self.refresh_lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"key#{self.index}"
+
+    def is_healthy(self, now=None):
+        """Check that the key is not taken out of rotation."""
+        return (now or time.monotonic()) >= self.cooldown_until
+
+    def has_valid_token(self, margin=timedelta(minutes=1)):
+        """Check that the token exists and stays valid for at least margin."""
+        return (self.access_token is not None and
+                self.token_expiry is not None and
+                datetime.now() + margin < self.token_expiry)
+
+
+class CredentialPool:
+    """Pool of GigaChat keys with least-loaded dispatch.
+
+    Requests go to the healthy key with the fewest requests in flight. A key
+    is taken out of rotation for rate_limit_cooldown_s after a 429 (or for
+    the Retry-After period) and for auth_failure_cooldown_s when the OAuth
+    endpoint rejects it or its token is rejected twice in a row. Network
+    errors and 5xx responses of the OAuth endpoint only pause the key for
+    transient_backoff_s. 429s, repeated 401s and transient token errors never
+    pause the last key in rotation: like a single-key setup without the pool,
+    only the failed request is lost.
+    """
+
+    # Причины вывода ключа из ротации
+    COOLDOWN_RATE_LIMIT = "rate_limit"
+    COOLDOWN_AUTH = "auth"
+    COOLDOWN_TRANSIENT = "transient"
+
+    # Результаты запроса токена
+    TOKEN_OK = "ok"
+    TOKEN_REJECTED = "rejected"
+    TOKEN_UNAVAILABLE = "unavailable"
+
+    def __init__(self, credentials, session, tracer=None,
+                 rate_limit_cooldown_s=60, auth_failure_cooldown_s=300, transient_backoff_s=10):
+        if not credentials:
+            raise ValueError("At least one GigaChat credential is required")
+        self.credentials = [
+            GigaChatCredential(index, client_id, client_secret)
+            for index, (client_id, client_secret) in enumerate(credentials, start=1)
+        ]
+        self.session = session
+        self.tracer = tracer or RequestTracer()
+        self.rate_limit_cooldown_s = rate_limit_cooldown_s
+        self.auth_failure_cooldown_s = auth_failure_cooldown_s
+        self.transient_backoff_s = transient_backoff_s
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def rate_limited(self):
+        """Check whether all keys are out of rotation because of 429s."""
+        now = time.monotonic()
+        return all(
+            not credential.is_healthy(now) and credential.cooldown_reason == self.COOLDOWN_RATE_LIMIT
+            for credential in self.credentials
+        )
+
+    def can_retry(self, credential, response):
+        """Check whether a request rejected with 401/429 may be sent again.
+
+        A retry goes to another key in rotation. After the first 401 the same
+        key may be retried as well, since acquire() will request a new token.
+        """
+        now = time.monotonic()
+        if any(other.is_healthy(now) for other in self.credentials if other is not credential):
+            return True
+        return (response.status_code == 401 and
+                credential.consecutive_auth_failures < 2 and
+                credential.is_healthy(now))
+
+    def _is_last_in_rotation(self, credential, now):
+        return not any(other.is_healthy(now) for other in self.credentials if other is not credential)
+
+    def _cool_down(self, credential, seconds, reason):
+        credential.cooldown_until = time.monotonic() + seconds
+        credential.cooldown_reason = reason
+
+    async def acquire(self, prefer=None):
+        """Choose the least-loaded healthy key, obtaining its token if needed.
+
+        Token requests run in a worker thread, so a slow OAuth endpoint does
+        not stall the event loop.
+
+        prefer is the index of a key to try first while it is healthy (used to
+        keep a chat on the account that holds its cached prompt). Returns None
+        when no key can serve the request. The key counts as loaded only while
+        calls wrapped with track() run, so choosing it before lane admission
+        does not skew the least-loaded choice.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = sorted(
+                (credential for credential in self.credentials if credential.is_healthy(now)),
+                key=lambda credential: (credential.index != prefer, credential.in_flight, credential.requests)
+            )
+
+        for credential in candidates:
+            if not credential.has_valid_token() and not await asyncio.to_thread(self.refresh, credential):
+                continue
+            with self._lock:
+                if not credential.is_healthy():
+                    continue
+                # Счетчик запросов разводит одновременно выбирающих по разным ключам
+                credential.requests += 1
+            return credential
+        return None
+
+    def track(self, credential, func):
+        """Wrap a blocking GigaChat call to count it in the key's in_flight.
+
+        The wrapper runs in a lane thread after admission, so time spent
+        waiting for a lane slot is not counted as load on the key.
+        """
+        @functools.wraps(func)
+        def tracked(*args, **kwargs):
+            with self._lock:
+                credential.in_flight += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    credential.in_flight -= 1
+        return tracked
+
+    def report(self, credential, response):
+        """Update key state from a GigaChat response."""
+        if response is None:
+            return
+        with self._lock:
+            if response.status_code == 429:
+                credential.rate_limited += 1
+                cooldown = self.rate_limit_cooldown_s
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    cooldown = max(cooldown, int(retry_after))
+                if self._is_last_in_rotation(credential, time.monotonic()):
+                    logger.warning("Ключ %s получил 429, других ключей в ротации нет", credential.name)
+                else:
+                    self._cool_down(credential, cooldown, self.COOLDOWN_RATE_LIMIT)
+                    logger.warning("Ключ %s получил 429, выведен из ротации на %s с", credential.name, cooldown)
+            elif response.status_code == 401:
+                # Первый 401 обычно означает истекший токен: сбрасываем его и
+                # получаем новый при следующем запросе. Повторный 401 подряд
+                # выводит ключ из ротации.
+                credential.auth_failures += 1
+                credential.consecutive_auth_failures += 1
+                credential.access_token = None
+                if credential.consecutive_auth_failures >= 2:
+                    if self._is_last_in_rotation(credential, time.monotonic()):
+                        logger.warning("Повторная ошибка авторизации ключа %s, других ключей в ротации нет",
+                                       credential.name)
+                    else:
+                        self._cool_down_auth(credential)
+            elif response.status_code < 400:
+                credential.consecutive_auth_failures = 0
+
+    def _cool_down_auth(self, credential):
+        self._cool_down(credential, self.auth_failure_cooldown_s, self.COOLDOWN_AUTH)
+        logger.warning("Ошибка авторизации ключа %s, выведен из ротации на %s с",
+                       credential.name, self.auth_failure_cooldown_s)
+
+    def _back_off(self, credential):
+        if self._is_last_in_rotation(credential, time.monotonic()):
+            # Последний ключ в ротации не выводим: следующий запрос снова попробует получить токен
+            logger.warning("Токен для ключа %s временно недоступен, других ключей в ротации нет", credential.name)
+            return
+        self._cool_down(credential, self.transient_backoff_s, self.COOLDOWN_TRANSIENT)
+        logger.warning("Токен для ключа %s временно недоступен, пауза %s с",
+                       credential.name, self.transient_backoff_s)
+
+    def refresh(self, credential, margin=timedelta(minutes=1)):
+        """Get access token for the given key from GigaChat API.
+
+        Blocking: call it from a worker thread, not from the event loop.
+        """
+        with credential.refresh_lock:
+            # Токен мог обновить другой поток, пока мы ждали блокировку
+            if credential.has_valid_token(margin):
+                return True
+            result = self._request_token(credential)
+            if result == self.TOKEN_OK:
+                return True
+            with self._lock:
+                if result == self.TOKEN_REJECTED:
+                    credential.auth_failures += 1
+                    self._cool_down_auth(credential)
+                else:
+                    self._back_off(credential)
+            return False
+
+    def refresh_expiring(self):
+        """Refresh tokens that are missing or expire within five minutes."""
+        for credential in self.credentials:
+            if not credential.is_healthy():
+                continue
+            if not credential.has_valid_token(timedelta(minutes=5)):
+                logger.info("Updating access token for %s...", credential.name)
+                self.refresh(credential, margin=timedelta(minutes=5))
+
+    def _request_token(self, credential):
+        """Request a token; returns one of the TOKEN_* results."""
+        try:
+            auth_string = f"{credential.client_id}:{credential.client_secret}"
+            auth_key = base64.b64encode(auth_string.encode()).decode()
+            request_id = str(uuid.uuid4())
+            logger.debug("Making token request for %s with request ID: %s", credential.name, request_id)
+
+            data = urlencode({
+                "scope": "GIGACHAT_API_PERS",
+            })
+
+            logger.debug("Encoded form data: %s", data)
+
+            with self.tracer.span("gigachat.token", key=credential.name) as span:
+                response = self.session.post(
+                    "https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
+                    headers={
+                        "Authorization": f"Basic {auth_key}",
+                        "RqUID": request_id,
+                        "Content-Type": "application/x-www-form-urlencoded",
+                        "Accept": "application/json"
+                    },
+                    data=data,
+                    verify=False
+                )
+                span.set("status_code", response.status_code)
+
+            logger.debug("Token request response status: %s", response.status_code)
+            logger.debug("Token request response: %s", response.text[:200])
+
+            if response.status_code == 200:
+                try:
+                    data = response.json()
+                    if "access_token" in data:
+                        credential.access_token = data["access_token"]
+                        credential.token_expiry = datetime.now() + timedelta(minutes=30)
+                        logger.info("Successfully obtained new access token for %s, expires at %s",
+                                    credential.name, credential.token_expiry)
+                        return self.TOKEN_OK
+                    else:
+                        logger.error("Access token not found in response data: %s", data)
+                        return self.TOKEN_UNAVAILABLE
+                except ValueError as e:
+                    logger.error("Failed to parse token response JSON: %s", str(e))
+                    return self.TOKEN_UNAVAILABLE
+            else:
+                logger.error("Token request failed. Status: %s, Response: %s",
+                          response.status_code, response.text[:200])
+                # 4xx (кроме 429) означает, что ключ отклонен; 429 и 5xx — временная проблема
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    return self.TOKEN_REJECTED
+                return self.TOKEN_UNAVAILABLE
+
+        except Exception as e:
+            logger.error("Error getting access token: %s", str(e))
+            return self.TOKEN_UNAVAILABLE
+
+    def snapshot(self):
+        """Return per-key load and rate-limit state."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                credential.name: {
+                    "healthy": credential.is_healthy(now),
+                    "cooldown_s": max(0, round(credential.cooldown_until - now)),
+                    "in_flight": credential.in_flight,
+                    "requests": credential.requests,
+                    "rate_limited": credential.rate_limited,
+                    "auth_failures": credential.auth_failures,
+                }
+                for credential in self.credentials
+            }
+
+
+class ChatSession:
+    """GigaChat prompt-caching session of a single chat."""
+    __slots__ = ("session_id", "credential_index", "sent_messages")
+
+    def __init__(self):
+        self.session_id = str(uuid.uuid4())
+        self.credential_index = None
+        self.sent_messages = []
+
+
+class SessionCache:
+    """Per-chat X-Session-ID sessions and prompt cache statistics.
+
+    GigaChat caches the processed prompt of a session on its side, so a
+    request whose messages start with everything sent previously in the same
+    session (and through the same key) does not need to be processed again.
+    The session is dropped on /clear; after a restart all chats start new
+    sessions.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.requests = 0
+        self.hits = 0
+        self.upstream_hits = 0
+        self.bytes_sent = 0
+        # Объем уже отправленного ранее начала диалога: он передается заново в каждом
+        # запросе, GigaChat лишь не обрабатывает его повторно
+        self.prefix_bytes = 0
+        # Токены промпта, взятые из кэша по данным GigaChat (precached_prompt_tokens)
+        self.cached_tokens = 0
+
+    def session_for(self, chat_id):
+        if chat_id not in self.sessions:
+            self.sessions[chat_id] = ChatSession()
+            logger.debug(f"Создана сессия {self.sessions[chat_id].session_id} для chat_id: {chat_id}")
+        return self.sessions[chat_id]
+
+    def reset(self, chat_id):
+        self.sessions.pop(chat_id, None)
+
+    def record(self, session, messages, credential, usage=None):
+        """Account a successful request and remember what was sent.
+
+        Returns True if the previous request of the session is a prefix of
+        this one, i.e. the upstream cache could be reused.
+        """
+        sent = session.sent_messages
+        hit = (bool(sent) and
+               session.credential_index == credential.index and
+               messages[:len(sent)] == sent)
+
+        total_bytes = len(json.dumps(messages).encode())
+        self.requests += 1
+        self.bytes_sent += total_bytes
+        if hit:
+            self.hits += 1
+            self.prefix_bytes += len(json.dumps(sent).encode())
+
+        precached_tokens = (usage or {}).get("precached_prompt_tokens") or 0
+        if precached_tokens:
+            self.upstream_hits += 1
+            self.cached_tokens += precached_tokens
+
+        session.credential_index = credential.index
+        session.sent_messages = list(messages)
+        return hit
+
+    def snapshot(self):
+        return {
+            "sessions": len(self.sessions),
+            "requests": self.requests,
+            "hit_rate": self.hits / self.requests if self.requests else 0.0,
+            "upstream_hit_rate": self.upstream_hits / self.requests if self.requests else 0.0,
+            "bytes_sent": self.bytes_sent,
+            "prefix_bytes": self.prefix_bytes,
+            "cached_tokens": self.cached_tokens,
+        }
+
+
+class GigaChatBot:
+    def __init__(self, bot_token, allowed_chat_ids, credentials, tracer=None, lanes=None,
+                 max_history_length=10, history_trim_slack=0):
+        """Initialize the GigaChat bot with the given credentials.
+
+        credentials is a list of (client_id, client_secret) pairs, one per
+        GigaChat authorization key. history_trim_slack lets the history grow
+        by that many messages past max_history_length before it is cut back.
+        """
+        self.bot_token = bot_token
+        self.allowed_chat_ids = [int(chat_id) for chat_id in allowed_chat_ids]
         self._stop_event = threading.Event()
+        self.tracer = tracer or RequestTracer()
+        # Раздельные полосы выполнения для текста, генерации изображений и анализа файлов
+        self.lanes = lanes or PriorityLaneExecutor()
 
-        # Добавляем хранение истории чатов и контекстов
+        # Добавляем хранение истории чатов и сессий кэширования
         self.chat_histories = {}
-        self.chat_contexts = {}  # Хранение context_id для каждого чата
+        self.session_cache = SessionCache()
+        # Апдейты обрабатываются параллельно, поэтому сообщения одного чата сериализуем
+        self.chat_locks = {}
         # Максимальное количество сообщений в истории
-        self.max_history_length = 10
+        self.max_history_length = max_history_length
+        # Сколько сообщений сверх лимита история может накопить до обрезки (по умолчанию 0:
+        # обрезка на каждом ходе). Запас сохраняет начало истории неизменным несколько ходов
+        # подряд для кэша сессии, но делает запросы длиннее
+        self.history_trim_slack = history_trim_slack
 
         # Создаем сессию для работы с API
         self.session = requests.Session()
         self.session.verify = False
+        # Пул соединений должен вмещать все одновременные запросы из полос
+        adapter = HTTPAdapter(pool_maxsize=self.lanes.total_concurrency + 2)
+        self.session.mount("https://", adapter)
         logger.warning("SSL verification is disabled")
 
+        # Пул ключей GigaChat: запросы уходят на наименее загруженный ключ
+        self.credentials = CredentialPool(credentials, self.session, tracer=self.tracer)
+        logger.info("Loaded %s GigaChat authorization key(s)", len(self.credentials))
+
         # Initialize the application
-        self.application = Application.builder().token(bot_token).build()
+        self.application = (
+            Application.builder()
+            .token(bot_token)
+            .concurrent_updates(True)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
 
         # Add handlers
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("image", self.generate_image))
         self.application.add_handler(CommandHandler("clear", self.clear_history))
+        self.application.add_handler(CommandHandler("stats", self.show_stats))
         self.application.add_handler(MessageHandler(
             filters.PHOTO | filters.Document.ALL, 
             self.process_file
         ))
         self.application.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND, 
-            self.handle_message
+            self.handle_text_update
         ))
 
+    async def _post_shutdown(self, application):
+        """Stop lane thread pools and flush traces when the application stops."""
+        self.lanes.shutdown()
+        self.tracer.shutdown()
+        logger.info("Полосы выполнения и трассировка остановлены")
+
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command."""
         chat_id = update.effective_chat.id
@@ -99,6 +966,26 @@ class GigaChatBot:
             "• Использовать команду /clear для очистки истории чата"
         )
 
+    @traced("handle_message")
+    async def handle_text_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Process text messages of one chat strictly one after another."""
+        chat_id = update.effective_chat.id
+        if chat_id not in self.allowed_chat_ids:
+            return await self.handle_message(update, context)
+
+        # Ожидание предыдущего сообщения того же чата входит в трассировку
+        lock = self.chat_lock(chat_id)
+        with self.tracer.span("chat_lock_wait"):
+            await lock.acquire()
+        try:
+            await self.handle_message(update, context)
+        finally:
+            lock.release()
+
+    def chat_lock(self, chat_id):
+        """Lock serializing everything that reads or modifies a chat's history."""
+        return self.chat_locks.setdefault(chat_id, asyncio.Lock())
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming messages."""
         chat_id = update.effective_chat.id
@@ -109,20 +996,26 @@ class GigaChatBot:
             return
 
         try:
-            # Ensure we have a valid access token
-            if not self.access_token and not self.get_access_token():
-                logger.error("Failed to obtain access token")
+            # Выбираем ключ GigaChat: по возможности тот же, что хранит кэш сессии чата,
+            # иначе наименее загруженный с действующим токеном
+            session = self.session_cache.session_for(chat_id)
+            credential = await self.credentials.acquire(prefer=session.credential_index)
+            if credential is None:
+                logger.error("No GigaChat credentials available")
                 await update.message.reply_text(
+                    "❌ Превышен лимит запросов к GigaChat API. Повторите попытку позже."
+                    if self.credentials.rate_limited() else
                     "Ошибка авторизации в GigaChat API. Пожалуйста, попробуйте позже.",
                     reply_to_message_id=update.message.message_id
                 )
                 return
 
             # Отправляем сообщение о начале обработки
-            processing_message = await update.message.reply_text(
-                "💭 Обрабатываю ваше сообщение...",
-                reply_to_message_id=update.message.message_id
-            )
+            with self.tracer.span("telegram.send_status"):
+                processing_message = await update.message.reply_text(
+                    "💭 Обрабатываю ваше сообщение...",
+                    reply_to_message_id=update.message.message_id
+                )
 
             # Получаем или инициализируем историю чата
             if chat_id not in self.chat_histories:
@@ -142,8 +1035,10 @@ class GigaChatBot:
 
             logger.debug(f"История чата для {chat_id} после добавления сообщения пользователя: {len(self.chat_histories[chat_id])} сообщений")
 
-            # Ограничиваем длину истории, сохраняя системное сообщение
-            if len(self.chat_histories[chat_id]) > self.max_history_length + 1:  # +1 для системного сообщения
+            # Ограничиваем длину истории, сохраняя системное сообщение. История растет до
+            # max_history_length + history_trim_slack и затем обрезается обратно до лимита
+            history_limit = self.max_history_length + self.history_trim_slack
+            if len(self.chat_histories[chat_id]) > history_limit + 1:  # +1 для системного сообщения
                 system_message = self.chat_histories[chat_id][0]
                 self.chat_histories[chat_id] = [system_message] + self.chat_histories[chat_id][-(self.max_history_length):]
                 logger.debug(f"История чата для {chat_id} обрезана до {self.max_history_length} сообщений + системное")
@@ -157,30 +1052,35 @@ class GigaChatBot:
                 "update_interval": 0
             }
 
-            # Добавляем context_id если он есть
-            if chat_id in self.chat_contexts:
-                request_data["context_id"] = self.chat_contexts[chat_id]
-
             logger.debug(f"Отправка запроса к API с {len(self.chat_histories[chat_id])} сообщениями")
 
-            response = self.session.post(
-                "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json",
-                },
-                json=request_data,
-                verify=False
-            )
+            with self.tracer.span("gigachat.completion", model=request_data["model"],
+                                  messages=len(request_data["messages"]), key=credential.name) as span:
+                response = await self.lanes.run(
+                    "text",
+                    self.credentials.track(credential, self.session.post),
+                    "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {credential.access_token}",
+                        "Content-Type": "application/json",
+                        "X-Session-ID": session.session_id,
+                        **request_id_header(),
+                    },
+                    json=request_data,
+                    verify=False
+                )
+                span.set("status_code", response.status_code)
+            self.credentials.report(credential, response)
 
             if response.status_code == 200:
                 data = response.json()
                 bot_response = data["choices"][0]["message"]["content"]
 
-                # Сохраняем context_id для следующих сообщений
-                if "context_id" in data:
-                    self.chat_contexts[chat_id] = data["context_id"]
-                    logger.debug(f"Сохранен context_id для chat_id {chat_id}: {data['context_id']}")
+                # Учитываем попадание в кэш сессии до добавления ответа в историю
+                cache_hit = self.session_cache.record(session, request_data["messages"], credential, data.get("usage"))
+                set_trace_attribute("cache_hit", cache_hit)
+                logger.debug(f"Сессия {session.session_id} для chat_id {chat_id}: "
+                             f"{'попадание' if cache_hit else 'промах'} кэша")
 
                 # Добавляем ответ бота в историю
                 self.chat_histories[chat_id].append({
@@ -190,18 +1090,26 @@ class GigaChatBot:
 
                 logger.debug(f"История чата для {chat_id} после добавления ответа бота: {len(self.chat_histories[chat_id])} сообщений")
 
-                await processing_message.delete()
-                await update.message.reply_text(
-                    bot_response,
-                    reply_to_message_id=update.message.message_id
-                )
+                with self.tracer.span("telegram.send"):
+                    await processing_message.delete()
+                    await update.message.reply_text(
+                        bot_response,
+                        reply_to_message_id=update.message.message_id
+                    )
                 logger.info("Successfully sent response to user")
 
-            elif response.status_code == 401:
-                logger.warning("Token expired, attempting to refresh...")
-                if self.get_access_token():
+            elif response.status_code in (401, 429):
+                logger.warning("GigaChat key %s responded with %s",
+                               credential.name, response.status_code)
+                if self.credentials.can_retry(credential, response):
+                    # Повторная обработка снова добавит сообщение пользователя
+                    self.chat_histories[chat_id].pop()
                     await processing_message.delete()
                     return await self.handle_message(update, context)
+                elif response.status_code == 429:
+                    await processing_message.edit_text(
+                        "❌ Превышен лимит запросов к GigaChat API. Повторите попытку позже."
+                    )
                 else:
                     await processing_message.edit_text(
                         "❌ Ошибка авторизации в GigaChat API. Повторите попытку позже."
@@ -212,12 +1120,18 @@ class GigaChatBot:
                     "❌ Произошла ошибка при обработке запроса. Попробуйте позже."
                 )
 
+        except LaneRejectedError as e:
+            logger.warning("Request rejected by lane executor: %s", str(e))
+            await update.message.reply_text(
+                "⏳ Бот сейчас перегружен. Пожалуйста, повторите запрос чуть позже."
+            )
         except Exception as e:
             logger.error("Error processing message: %s", str(e))
             await update.message.reply_text(
                 "❌ Произошла непредвиденная ошибка. Пожалуйста, попробуйте позже."
             )
 
+    @traced("generate_image")
     async def generate_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle image generation command."""
         chat_id = update.effective_chat.id
@@ -239,32 +1153,43 @@ class GigaChatBot:
         logger.debug("Processing image generation: %s", prompt)
 
         try:
-            if not self.access_token and not self.get_access_token():
-                logger.error("Failed to obtain access token")
+            # Генерация и скачивание изображения должны идти через один ключ
+            credential = await self.credentials.acquire()
+            if credential is None:
+                logger.error("No GigaChat credentials available")
                 await update.message.reply_text(
+                    "❌ Превышен лимит запросов к GigaChat API. Повторите попытку позже."
+                    if self.credentials.rate_limited() else
                     "🚫 Ошибка авторизации в GigaChat API. Пожалуйста, попробуйте позже."
                 )
                 return
 
-            status_message = await update.message.reply_text(
-                "🎨 Генерирую изображение, пожалуйста, подождите..."
-            )
+            with self.tracer.span("telegram.send_status"):
+                status_message = await update.message.reply_text(
+                    "🎨 Генерирую изображение, пожалуйста, подождите..."
+                )
 
-            response = self.session.post(
-                "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": "GigaChat",
-                    "messages": [{"role": "user", "content": f"Нарисуй {prompt}"}],
-                    "temperature": 0.7,
-                    "max_tokens": 1500,
-                    "function_call": "auto"
-                },
-                verify=False
-            )
+            with self.tracer.span("gigachat.completion", model="GigaChat", key=credential.name) as span:
+                response = await self.lanes.run(
+                    "image",
+                    self.credentials.track(credential, self.session.post),
+                    "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {credential.access_token}",
+                        "Content-Type": "application/json",
+                        **request_id_header(),
+                    },
+                    json={
+                        "model": "GigaChat",
+                        "messages": [{"role": "user", "content": f"Нарисуй {prompt}"}],
+                        "temperature": 0.7,
+                        "max_tokens": 1500,
+                        "function_call": "auto"
+                    },
+                    verify=False
+                )
+                span.set("status_code", response.status_code)
+            self.credentials.report(credential, response)
 
             if response.status_code == 200:
                 data = response.json()
@@ -277,19 +1202,29 @@ class GigaChatBot:
                     file_id = img_match.group(1)
                     image_url = f"https://gigachat.devices.sberbank.ru/api/v1/files/{file_id}/content"
 
-                    image_response = self.session.get(
-                        image_url,
-                        headers={"Authorization": f"Bearer {self.access_token}"},
-                        verify=False
-                    )
+                    with self.tracer.span("gigachat.image_fetch") as span:
+                        image_response = await self.lanes.run(
+                            "image",
+                            self.credentials.track(credential, self.session.get),
+                            image_url,
+                            headers={
+                                "Authorization": f"Bearer {credential.access_token}",
+                                **request_id_header(),
+                            },
+                            verify=False
+                        )
+                        span.set("status_code", image_response.status_code)
+                        span.set("bytes", len(image_response.content))
+                    self.credentials.report(credential, image_response)
 
                     if image_response.status_code == 200:
                         caption = f"🎨 Сгенерированное изображение по запросу: {prompt}"
-                        await update.message.reply_photo(
-                            photo=image_response.content,
-                            caption=caption
-                        )
-                        await status_message.delete()
+                        with self.tracer.span("telegram.send"):
+                            await update.message.reply_photo(
+                                photo=image_response.content,
+                                caption=caption
+                            )
+                            await status_message.delete()
                     else:
                         logger.error("Error downloading image: %s - %s", 
                                    image_response.status_code, 
@@ -299,11 +1234,16 @@ class GigaChatBot:
                     logger.error("Image ID not found in response")
                     await status_message.edit_text("❌ Не удалось сгенерировать изображение.")
 
-            elif response.status_code == 401:
-                logger.warning("Token expired, attempting to refresh...")
-                if self.get_access_token():
+            elif response.status_code in (401, 429):
+                logger.warning("GigaChat key %s responded with %s",
+                               credential.name, response.status_code)
+                if self.credentials.can_retry(credential, response):
                     await status_message.delete()
                     return await self.generate_image(update, context)
+                elif response.status_code == 429:
+                    await status_message.edit_text(
+                        "❌ Превышен лимит запросов к GigaChat API. Повторите попытку позже."
+                    )
                 else:
                     await status_message.edit_text(
                         "❌ Ошибка авторизации в GigaChat API. Повторите попытку позже."
@@ -314,12 +1254,18 @@ class GigaChatBot:
                     "❌ Произошла ошибка при генерации изображения. Попробуйте позже."
                 )
 
+        except LaneRejectedError as e:
+            logger.warning("Image request rejected by lane executor: %s", str(e))
+            await update.message.reply_text(
+                "⏳ Сейчас много запросов на генерацию изображений. Пожалуйста, повторите попытку позже."
+            )
         except Exception as e:
             logger.error("Error generating image: %s", str(e))
             await update.message.reply_text(
                 "❌ Произошла непредвиденная ошибка при генерации изображения. Пожалуйста, попробуйте позже."
             )
 
+    @traced("process_file")
     async def process_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle file uploads."""
         chat_id = update.effective_chat.id
@@ -369,15 +1315,18 @@ class GigaChatBot:
                 return
 
             # Send initial processing status
-            status_message = await update.message.reply_text(
-                "🔄 Начинаю обработку файла..."
-            )
+            with self.tracer.span("telegram.send_status"):
+                status_message = await update.message.reply_text(
+                    "🔄 Начинаю обработку файла..."
+                )
 
             try:
                 # Download and validate file
-                file_obj = await context.bot.get_file(file.file_id)
-                file_content = await file_obj.download_as_bytearray()
-                file_size = len(file_content)
+                with self.tracer.span("telegram.download", mime_type=mime_type) as span:
+                    file_obj = await context.bot.get_file(file.file_id)
+                    file_content = await file_obj.download_as_bytearray()
+                    file_size = len(file_content)
+                    span.set("bytes", file_size)
                 max_size = max_image_size if is_image else max_text_size
                 size_limit_mb = "15MB" if is_image else "30MB"
 
@@ -387,192 +1336,176 @@ class GigaChatBot:
                     )
                     return
 
-                # Ensure we have a valid access token
-                if not self.access_token and not self.get_access_token():
-                    logger.error("Failed to obtain access token")
-                    await status_message.edit_text(
-                        "Ошибка авторизации в GigaChat API. Пожалуйста, попробуйте позже."
-                    )
-                    return
+                file_name = file.file_name if hasattr(file, 'file_name') else f"file.{mime_type.split('/')[-1]}"
+                await self._analyze_file(status_message, file_name, file_content, mime_type, is_image)
 
-                # Upload file to GigaChat API
-                logger.info("Uploading file to GigaChat API...")
-                await status_message.edit_text("🔄 Загружаю файл в систему анализа...")
+            except LaneRejectedError as e:
+                logger.warning(f"File request rejected by lane executor: {str(e)}")
+                await status_message.edit_text(
+                    "⏳ Сейчас много файлов в обработке. Пожалуйста, повторите попытку позже."
+                )
+            except Exception as e:
+                logger.error(f"Error in file processing: {str(e)}", exc_info=True)
+                await status_message.edit_text(
+                    "❌ Произошла ошибка при обработке файла. Пожалуйста, попробуйте позже."
+                )
 
-                # Prepare file upload
-                file_name = file.file_name if hasattr(file, 'file_name') else f"file.{mime_type.split('/')[-1]}"
-                files = {
-                    'file': (file_name, io.BytesIO(file_content), mime_type)
-                }
+        except Exception as e:
+            logger.error(f"Error processing file: {str(e)}", exc_info=True)
+            await update.message.reply_text(
+                "❌ Произошла ошибка при обработке файла. Пожалуйста, попробуйте позже."
+            )
 
-                logger.debug(f"Uploading file with name: {file_name}, mime_type: {mime_type}")
+    async def _analyze_file(self, status_message, file_name, file_content, mime_type, is_image):
+        """Upload an already downloaded file to GigaChat and show its analysis.
+
+        On 401/429 the upload and analysis are repeated through another key
+        with the same content, so the file is downloaded from Telegram once
+        and the same status message is updated.
+        """
+        while True:
+            # Загрузка и анализ файла должны идти через один ключ:
+            # загруженный файл доступен только его владельцу
+            credential = await self.credentials.acquire()
+            if credential is None:
+                logger.error("No GigaChat credentials available")
+                await status_message.edit_text(
+                    "❌ Превышен лимит запросов к GigaChat API. Повторите попытку позже."
+                    if self.credentials.rate_limited() else
+                    "Ошибка авторизации в GigaChat API. Пожалуйста, попробуйте позже."
+                )
+                return
+
+            # Upload file to GigaChat API
+            logger.info("Uploading file to GigaChat API...")
+            await status_message.edit_text("🔄 Загружаю файл в систему анализа...")
 
-                # Upload file
-                upload_response = self.session.post(
+            # Prepare file upload
+            files = {
+                'file': (file_name, io.BytesIO(file_content), mime_type)
+            }
+
+            logger.debug(f"Uploading file with name: {file_name}, mime_type: {mime_type}")
+
+            # Upload file
+            with self.tracer.span("gigachat.upload", bytes=len(file_content), key=credential.name) as span:
+                upload_response = await self.lanes.run(
+                    "file",
+                    self.credentials.track(credential, self.session.post),
                     "https://gigachat.devices.sberbank.ru/api/v1/files",
                     headers={
-                        "Authorization": f"Bearer {self.access_token}",
-                        "Accept": "application/json"
+                        "Authorization": f"Bearer {credential.access_token}",
+                        "Accept": "application/json",
+                        **request_id_header(),
                     },
                     data={'purpose': 'general'},
                     files=files,
                     verify=False
                 )
+                span.set("status_code", upload_response.status_code)
+            self.credentials.report(credential, upload_response)
 
-                logger.debug(f"Upload response status: {upload_response.status_code}")
-                logger.debug(f"Upload response: {upload_response.text[:200]}")
+            logger.debug(f"Upload response status: {upload_response.status_code}")
+            logger.debug(f"Upload response: {upload_response.text[:200]}")
 
-                if upload_response.status_code == 200:
-                    upload_data = upload_response.json()
-                    file_id = upload_data.get('id')
+            if (upload_response.status_code in (401, 429) and
+                    self.credentials.can_retry(credential, upload_response)):
+                logger.warning(f"GigaChat key {credential.name} responded with "
+                               f"{upload_response.status_code} during upload, retrying")
+                await status_message.edit_text("🔄 Повторяю запрос к GigaChat...")
+                continue
 
-                    if not file_id:
-                        raise ValueError("File ID not found in response")
-
-                    # Update status
-                    await status_message.edit_text("🔄 Анализирую содержимое...")
-
-                    # Prepare analysis prompt based on file type
-                    if is_image:
-                        prompt = "Опиши подробно, что изображено на этой фотографии?"
-                    else:
-                        prompt = "Проанализируй содержимое документа и предоставь краткую сводку основных моментов."
-
-                    # Send the analysis request
-                    completion_response = self.session.post(
-                        "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {self.access_token}",
-                            "Content-Type": "application/json",
-                        },
-                        json={
-                            "model": "GigaChat-Pro",
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": prompt,
-                                    "attachments": [file_id]
-                                }
-                            ],
-                            "temperature": 0.7,
-                        },
-                        verify=False
-                    )
-
-                    if completion_response.status_code == 200:
-                        try:
-                            response_data = completion_response.json()
-                            analysis = response_data["choices"][0]["message"]["content"]
-                            logger.info("Successfully received content analysis")
-                            file_type = "изображения" if is_image else "документа"
-                            await status_message.edit_text(f"📝 Результат анализа {file_type}:\n\n{analysis}")
-                        except (KeyError, IndexError, ValueError) as e:
-                            logger.error(f"Error parsing analysis response: {str(e)}")
-                            await status_message.edit_text(
-                                "❌ Ошибка при обработке ответа от API. Пожалуйста, попробуйте позже."
-                            )
-                    elif completion_response.status_code == 401:
-                        logger.warning("Token expired during file analysis, attempting to refresh...")
-                        if self.get_access_token():
-                            logger.info("Token refreshed successfully, retrying file analysis")
-                            return await self.process_file(update, context)
-                        else:
-                            await status_message.edit_text(
-                                "❌ Ошибка авторизации. Пожалуйста, попробуйте позже."
-                            )
-                    else:
-                        error_message = "Неизвестная ошибка"
-                        try:
-                            error_data = completion_response.json()
-                            error_message = error_data.get("error", {}).get("message", error_message)
-                        except:
-                            pass
-
-                        logger.error(f"Analysis failed: {completion_response.status_code} - {error_message}")
-                        await status_message.edit_text(
-                            f"❌ Ошибка при анализе файла: {error_message}"
-                        )
-
-                else:
-                    logger.error(f"File upload failed: {upload_response.text}")
-                    await status_message.edit_text(
-                        "❌ Ошибка при загрузке файла. Пожалуйста, попробуйте позже."
-                    )
-
-            except Exception as e:
-                logger.error(f"Error in file processing: {str(e)}", exc_info=True)
+            if upload_response.status_code != 200:
+                logger.error(f"File upload failed: {upload_response.text}")
                 await status_message.edit_text(
-                    "❌ Произошла ошибка при обработке файла. Пожалуйста, попробуйте позже."
+                    "❌ Ошибка при загрузке файла. Пожалуйста, попробуйте позже."
                 )
+                return
 
-        except Exception as e:
-            logger.error(f"Error processing file: {str(e)}", exc_info=True)
-            await update.message.reply_text(
-                "❌ Произошла ошибка при обработке файла. Пожалуйста, попробуйте позже."
-            )
-
-    def get_access_token(self):
-        """Get access token from GigaChat API."""
-        try:
-            auth_string = f"{self.client_id}:{self.client_secret}"
-            auth_key = base64.b64encode(auth_string.encode()).decode()
-            request_id = str(uuid.uuid4())
-            logger.debug("Making token request with request ID: %s", request_id)
-
-            data = urlencode({
-                "scope": "GIGACHAT_API_PERS",
-            })
+            upload_data = upload_response.json()
+            file_id = upload_data.get('id')
 
-            logger.debug("Encoded form data: %s", data)
+            if not file_id:
+                raise ValueError("File ID not found in response")
 
-            response = self.session.post(
-                "https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
-                headers={
-                    "Authorization": f"Basic {auth_key}",
-                    "RqUID": request_id,
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "Accept": "application/json"
-                },
-                data=data,
-                verify=False
-            )
+            # Update status
+            await status_message.edit_text("🔄 Анализирую содержимое...")
 
-            logger.debug("Token request response status: %s", response.status_code)
-            logger.debug("Token request response: %s", response.text[:200])
+            # Prepare analysis prompt based on file type
+            if is_image:
+                prompt = "Опиши подробно, что изображено на этой фотографии?"
+            else:
+                prompt = "Проанализируй содержимое документа и предоставь краткую сводку основных моментов."
+
+            # Send the analysis request
+            with self.tracer.span("gigachat.completion", model="GigaChat-Pro", key=credential.name) as span:
+                completion_response = await self.lanes.run(
+                    "file",
+                    self.credentials.track(credential, self.session.post),
+                    "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {credential.access_token}",
+                        "Content-Type": "application/json",
+                        **request_id_header(),
+                    },
+                    json={
+                        "model": "GigaChat-Pro",
+                        "messages": [
+                            {
+                                "role": "user",
+                                "content": prompt,
+                                "attachments": [file_id]
+                            }
+                        ],
+                        "temperature": 0.7,
+                    },
+                    verify=False
+                )
+                span.set("status_code", completion_response.status_code)
+            self.credentials.report(credential, completion_response)
 
-            if response.status_code == 200:
+            if completion_response.status_code == 200:
                 try:
-                    data = response.json()
-                    if "access_token" in data:
-                        self.access_token = data["access_token"]
-                        self.token_expiry = datetime.now() + timedelta(minutes=30)
-                        logger.info("Successfully obtained new access token, expires at %s", self.token_expiry)
-                        return True
-                    else:
-                        logger.error("Access token not found in response data: %s", data)
-                        return False
-                except ValueError as e:
-                    logger.error("Failed to parse token response JSON: %s", str(e))
-                    return False
+                    response_data = completion_response.json()
+                    analysis = response_data["choices"][0]["message"]["content"]
+                    logger.info("Successfully received content analysis")
+                    file_type = "изображения" if is_image else "документа"
+                    with self.tracer.span("telegram.send"):
+                        await status_message.edit_text(f"📝 Результат анализа {file_type}:\n\n{analysis}")
+                except (KeyError, IndexError, ValueError) as e:
+                    logger.error(f"Error parsing analysis response: {str(e)}")
+                    await status_message.edit_text(
+                        "❌ Ошибка при обработке ответа от API. Пожалуйста, попробуйте позже."
+                    )
+            elif completion_response.status_code in (401, 429):
+                logger.warning("GigaChat key %s responded with %s during file analysis",
+                               credential.name, completion_response.status_code)
+                if self.credentials.can_retry(credential, completion_response):
+                    logger.info("Retrying file analysis")
+                    await status_message.edit_text("🔄 Повторяю запрос к GigaChat...")
+                    continue
+                await status_message.edit_text(
+                    "❌ Ошибка авторизации. Пожалуйста, попробуйте позже."
+                )
             else:
-                logger.error("Token request failed. Status: %s, Response: %s",
-                          response.status_code, response.text[:200])
-                return False
+                error_message = "Неизвестная ошибка"
+                try:
+                    error_data = completion_response.json()
+                    error_message = error_data.get("error", {}).get("message", error_message)
+                except:
+                    pass
 
-        except Exception as e:
-            logger.error("Error getting access token: %s", str(e))
-            return False
+                logger.error(f"Analysis failed: {completion_response.status_code} - {error_message}")
+                await status_message.edit_text(
+                    f"❌ Ошибка при анализе файла: {error_message}"
+                )
+            return
 
     def _token_update_loop(self):
-        """Background thread to update the access token."""
+        """Background thread to update the access tokens of all keys."""
         while not self._stop_event.is_set():
             try:
-                current_time = datetime.now()
-                if (not self.access_token or 
-                    self.token_expiry is None or 
-                    current_time + timedelta(minutes=5) >= self.token_expiry):
-                    logger.info("Updating access token...")
-                    self.get_access_token()
+                self.credentials.refresh_expiring()
                 time.sleep(60)  # Check every minute
             except Exception as e:
                 logger.error("Error in token update loop: %s", str(e))
@@ -584,21 +1517,74 @@ class GigaChatBot:
         if chat_id not in self.allowed_chat_ids:
             return
 
-        # Сохраняем только системное сообщение при очистке
-        if chat_id in self.chat_histories:
-            system_message = {
-                "role": "system",
-                "content": "Ты — умный и дружелюбный ассистент. Отвечай подробно, но по существу. "
-                "Поддерживай контекст диалога и учитывай предыдущие сообщения при ответе. "
-                "Если не уверен в ответе, так и скажи."
-            }
-            self.chat_histories[chat_id] = [system_message]
-            # Очищаем context_id
-            if chat_id in self.chat_contexts:
-                del self.chat_contexts[chat_id]
-            await update.message.reply_text("✨ История чата очищена!")
-        else:
-            await update.message.reply_text("История чата уже пуста.")
+        # Дожидаемся ответа на сообщение в обработке, иначе он попадет в очищенную историю
+        async with self.chat_lock(chat_id):
+            # Сохраняем только системное сообщение при очистке
+            if chat_id in self.chat_histories:
+                system_message = {
+                    "role": "system",
+                    "content": "Ты — умный и дружелюбный ассистент. Отвечай подробно, но по существу. "
+                    "Поддерживай контекст диалога и учитывай предыдущие сообщения при ответе. "
+                    "Если не уверен в ответе, так и скажи."
+                }
+                self.chat_histories[chat_id] = [system_message]
+                # Начинаем новую сессию: кэш старой больше не соответствует истории
+                self.session_cache.reset(chat_id)
+                await update.message.reply_text("✨ История чата очищена!")
+            else:
+                await update.message.reply_text("История чата уже пуста.")
+
+    async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показать метрики полос выполнения, ключей GigaChat и кэша сессий."""
+        chat_id = update.effective_chat.id
+        if chat_id not in self.allowed_chat_ids:
+            return
+
+        lines = ["📊 Полосы выполнения:"]
+        if self.lanes.text_slo_breached():
+            lines.append("⚠️ SLO задержки текстовых ответов нарушен, тяжелые запросы ограничены")
+        for name, metrics in self.lanes.snapshot().items():
+            lines.append(
+                f"\n{name}: {metrics['running']}/{metrics['concurrency']} в работе, "
+                f"{metrics['queued']} в очереди\n"
+                f"  выполнено {metrics['completed']}, ошибок {metrics['failed']}, "
+                f"отклонено {metrics['rejected']}, отложено {metrics['throttled']}\n"
+                f"  ожидание p50/p95: {metrics['queue_wait_p50_ms']:.0f}/{metrics['queue_wait_p95_ms']:.0f} мс\n"
+                f"  задержка p50/p95: {metrics['latency_p50_ms']:.0f}/{metrics['latency_p95_ms']:.0f} мс"
+            )
+
+        lines.append("\n🔑 Ключи GigaChat:")
+        for name, state in self.credentials.snapshot().items():
+            status = "в ротации" if state["healthy"] else f"пауза {state['cooldown_s']} с"
+            lines.append(
+                f"{name}: {status}, в работе {state['in_flight']}, запросов {state['requests']}, "
+                f"429: {state['rate_limited']}, ошибок авторизации {state['auth_failures']}"
+            )
+
+        cache = self.session_cache.snapshot()
+        lines.append(
+            f"\n🗂 Кэш сессий: {cache['sessions']} сессий, запросов {cache['requests']}\n"
+            f"  попаданий {cache['hit_rate']:.0%} (по данным GigaChat {cache['upstream_hit_rate']:.0%}), "
+            f"сэкономлено токенов промпта {cache['cached_tokens']}\n"
+            f"  отправлено {cache['bytes_sent'] // 1024} КБ, из них повторяющееся начало диалога "
+            f"{cache['prefix_bytes'] // 1024} КБ"
+        )
+        await update.message.reply_text("\n".join(lines))
+
+
+def decode_authorization_key(auth_key):
+    """Decode a base64 client_id:client_secret key into its parts."""
+    try:
+        # Try to decode the key to validate it
+        decoded_auth = base64.b64decode(auth_key).decode()
+        if ':' not in decoded_auth:
+            raise ValueError("Invalid authorization key format: missing client_id:client_secret separator")
+        client_id, client_secret = decoded_auth.split(':', 1)
+        if not client_id or not client_secret:
+            raise ValueError("Invalid client credentials in authorization key")
+        return client_id, client_secret
+    except Exception as e:
+        raise ValueError(f"Invalid authorization key: {str(e)}")
 
 
 def load_secrets():
@@ -609,24 +1595,19 @@ def load_secrets():
             logger.info("Secrets loaded successfully")
             logger.debug(f"Allowed chat IDs: {secrets.get('telegram_allowed_chat_ids')}")
 
-            # Validate the authorization key
-            auth_key = secrets.get("gigachat_authorization_key")
-            if not auth_key:
+            # Один ключ в gigachat_authorization_key и/или список в gigachat_authorization_keys
+            auth_keys = list(secrets.get("gigachat_authorization_keys") or [])
+            if secrets.get("gigachat_authorization_key"):
+                auth_keys.insert(0, secrets["gigachat_authorization_key"])
+            if not auth_keys:
                 raise ValueError("GigaChat authorization key not found in secrets")
 
-            try:
-                # Try to decode the key to validate it
-                decoded_auth = base64.b64decode(auth_key).decode()
-                if ':' not in decoded_auth:
-                    raise ValueError("Invalid authorization key format: missing client_id:client_secret separator")
-                client_id, client_secret = decoded_auth.split(':', 1)
-                if not client_id or not client_secret:
-                    raise ValueError("Invalid client credentials in authorization key")
-                logger.info("Successfully validated authorization key format")
-                secrets["client_id"] = client_id
-                secrets["client_secret"] = client_secret
-            except Exception as e:
-                raise ValueError(f"Invalid authorization key: {str(e)}")
+            # Validate the authorization keys
+            credentials = []
+            for auth_key in dict.fromkeys(auth_keys):
+                credentials.append(decode_authorization_key(auth_key))
+            logger.info("Successfully validated format of %s authorization key(s)", len(credentials))
+            secrets["credentials"] = credentials
 
             return secrets
     except Exception as e:
@@ -697,8 +1678,14 @@ if __name__ == "__main__":
         bot = GigaChatBot(
             bot_token=secrets["telegram_bot_api_key"],
             allowed_chat_ids=secrets["telegram_allowed_chat_ids"],
-            client_id=secrets["client_id"],
-            client_secret=secrets["client_secret"]
+            credentials=secrets["credentials"],
+            tracer=RequestTracer.from_config(secrets.get("tracing")),
+            lanes=PriorityLaneExecutor.from_config(
+                secrets.get("lanes"),
+                scale=len(secrets["credentials"])
+            ),
+            max_history_length=int((secrets.get("history") or {}).get("max_length", 10)),
+            history_trim_slack=int((secrets.get("history") or {}).get("trim_slack", 0))
         )
 
         # Set up signal handlers for graceful shutdown